@@ -15,10 +15,12 @@
 
 # -*- coding: utf-8 -*-
 
-from typing import Union
+from functools import partial
+from typing import Optional, Union
 
 import numpy as onp
-from jax import vmap, lax, numpy as jnp
+import jax
+from jax import lax, numpy as jnp
 import brainstate as bst
 
 __all__ = [
@@ -34,7 +36,8 @@ __all__ = [
 def cross_correlation(spikes: bst.typing.ArrayLike,
                       bin: Union[int, float],
                       dt: Union[int, float] =None,
-                      method: str = 'loop'):
+                      method: str = 'loop',
+                      chunk_size: Optional[int] = None):
   r"""Calculate cross correlation index between neurons.
 
   The coherence [1]_ between two neurons i and j is measured by their
@@ -68,8 +71,19 @@ def cross_correlation(spikes: bst.typing.ArrayLike,
       The time precision.
   method: str
     The method to calculate all pairs of cross correlation.
-    Supports two kinds of methods: `loop` and `vmap`.
-    `vmap` method needs much more memory.
+    `loop` and `vmap` are deprecated aliases: both compute all pairs
+    with a single matrix multiplication. `numba` packs the binned spike
+    states into 64-bit words and counts the coincidences of every pair
+    with a parallel popcount kernel, which is faster for small networks
+    on CPU.
+    It requires ``numba`` and cannot be JIT compiled by JAX.
+  chunk_size: int, optional
+    The number of neurons per tile of the pairwise matrix multiplication.
+    Each tile is reduced immediately, so the peak memory is bounded by
+    ``num_neuron * chunk_size`` instead of ``num_neuron ** 2``. The tiles
+    are iterated with ``lax.fori_loop``, so the compiled graph does not grow
+    with the number of tiles. By default, all pairs are computed in one tile.
+    It is ignored by the `numba` method.
 
   Returns
   -------
@@ -82,44 +96,85 @@ def cross_correlation(spikes: bst.typing.ArrayLike,
          inhibition in a hippocampal interneuronal network model." Journal of
          neuroscience 16.20 (1996): 6402-6413.
   """
+  if method not in ('loop', 'vmap', 'numba'):
+    raise ValueError(f'Do not support {method}. We only support "loop", "vmap" or "numba".')
   dt = bst.environ.get_dt() if dt is None else dt
   bin_size = int(bin / dt)
   num_hist, num_neu = spikes.shape
+  if num_neu < 2:
+    # there is no pair of neurons, for which all methods give NaN
+    return jnp.asarray(jnp.nan, dtype=jnp.float32)
   num_bin = int(onp.ceil(num_hist / bin_size))
+  spikes = jnp.asarray(spikes, dtype=jnp.bool_)
   if num_bin * bin_size != num_hist:
-    spikes = jnp.append(spikes, jnp.zeros((num_bin * bin_size - num_hist, num_neu)), axis=0)
-  states = spikes.T.reshape((num_neu, num_bin, bin_size))
-  states = jnp.asarray(jnp.sum(states, axis=2) > 0., dtype=jnp.float_)
-  indices = jnp.tril_indices(num_neu, k=-1)
-
-  if method == 'loop':
-    def _f(i, j):
-      sqrt_ij = jnp.sqrt(jnp.sum(states[i]) * jnp.sum(states[j]))
-      return lax.cond(sqrt_ij == 0.,
-                      lambda _: 0.,
-                      lambda _: jnp.sum(states[i] * states[j]) / sqrt_ij,
-                      None)
-
-    res = bst.transform.for_loop(_f, *indices)
-
-  elif method == 'vmap':
-    @vmap
-    def _cc(i, j):
-      sqrt_ij = jnp.sqrt(jnp.sum(states[i]) * jnp.sum(states[j]))
-      return lax.cond(sqrt_ij == 0.,
-                      lambda _: 0.,
-                      lambda _: jnp.sum(states[i] * states[j]) / sqrt_ij,
-                      None)
-
-    res = _cc(*indices)
+    # the last partial bin is padded with no spikes
+    spikes = jnp.pad(spikes, ((0, num_bin * bin_size - num_hist), (0, 0)))
+  # a bin is active when any of its time steps has a spike
+  states = jnp.any(spikes.T.reshape((num_neu, num_bin, bin_size)), axis=2)
+
+  if method == 'numba':
+    # numba is imported only when it is used, to keep importing braintools fast
+    try:
+      from ._correlation_numba import cc_numba
+    except ModuleNotFoundError as e:
+      if e.name != 'numba':
+        raise
+      raise ModuleNotFoundError('"numba" is required when method="numba". '
+                                'Please install it through "pip install numba".') from e
+    # pack eight bins per byte and view every eight bytes as one uint64 word
+    states = onp.asarray(states, dtype=onp.uint8)
+    packed = onp.packbits(states, axis=1)
+    packed = onp.pad(packed, ((0, 0), (0, -packed.shape[1] % 8)))
+    packed = onp.ascontiguousarray(packed).view(onp.uint64)
+    num_spk = states.sum(axis=1, dtype=onp.int64)
+    return jnp.asarray(cc_numba(packed, num_spk))
+
+  if chunk_size is None:
+    chunk_size = num_neu
+  if not isinstance(chunk_size, (int, onp.integer)) or isinstance(chunk_size, bool) or chunk_size <= 0:
+    raise ValueError(f'"chunk_size" should be a positive integer, but we got {chunk_size}.')
+  chunk_size = min(int(chunk_size), num_neu)
+
+  # The boolean states are promoted to float32 once, as the matmul operands.
+  num_spk = jnp.sum(states, axis=1, dtype=jnp.int32).astype(jnp.float32)
+  states = states.astype(jnp.float32)
+  if chunk_size == num_neu:
+    total = _cc_block(states, num_spk, states, num_spk, 0)
   else:
-    raise ValueError(f'Do not support {method}. We only support "loop" or "vmap".')
-
-  return jnp.mean(jnp.asarray(res))
-
-
-def _f_signal(signal):
-  return jnp.mean(signal * signal) - jnp.mean(signal) ** 2
+    total = _cc_tiles(states, num_spk, chunk_size)
+  return total / (num_neu * (num_neu - 1) / 2)
+
+
+def _cc_block(block, block_spk, states, num_spk, start):
+  # all pairs of a tile of neurons are computed with one matrix multiplication
+  # and reduced right away to the pairs (i, j) with j < i, where i is offset
+  # by the start of the tile
+  num = jnp.matmul(block, states.T)
+  den = jnp.sqrt(jnp.outer(block_spk, num_spk))
+  cc = jnp.where(den == 0., 0., num / jnp.where(den == 0., 1., den))
+  mask = jnp.arange(states.shape[0])[None, :] < (start + jnp.arange(block.shape[0]))[:, None]
+  return jnp.sum(jnp.where(mask, cc, 0.))
+
+
+@partial(jax.jit, static_argnames=('chunk_size',))
+def _cc_tiles(states, num_spk, chunk_size):
+  # The tiles run in a ``fori_loop`` over the states padded to a multiple of
+  # ``chunk_size``, so the traced graph does not grow with the number of tiles.
+  # The padded neurons have no spikes and thus contribute nothing. Jitting at
+  # the module level keeps the compiled loop cached between calls.
+  num_neu = states.shape[0]
+  num_tile = -(-num_neu // chunk_size)
+  num_pad = num_tile * chunk_size - num_neu
+  padded_states = jnp.pad(states, ((0, num_pad), (0, 0)))
+  padded_spk = jnp.pad(num_spk, (0, num_pad))
+
+  def _tile(i, total):
+    start = i * chunk_size
+    block = lax.dynamic_slice_in_dim(padded_states, start, chunk_size, axis=0)
+    block_spk = lax.dynamic_slice_in_dim(padded_spk, start, chunk_size)
+    return total + _cc_block(block, block_spk, states, num_spk, start)
+
+  return lax.fori_loop(0, num_tile, _tile, jnp.zeros((), dtype=jnp.float32))
 
 
 def voltage_fluctuation(potentials, method='loop'):
@@ -166,25 +221,25 @@ def voltage_fluctuation(potentials, method='loop'):
 
   Args:
     potentials: The membrane potential matrix of the neuron group.
-    method: The method to calculate all pairs of cross correlation.
-       Supports two kinds of methods: `loop` and `vmap`.
-      `vmap` method will consume much more memory.
+    method: Deprecated. The variance of all neurons is now computed in a
+      single vectorized pass, so `loop` and `vmap` behave identically.
 
   Returns:
     sync_index: The synchronization index.
   """
 
+  # centered (two-pass) variances avoid the catastrophic cancellation of
+  # E[x^2] - E[x]^2 when the potentials have a large offset, e.g. -65 mV
   avg = jnp.mean(potentials, axis=1)
-  avg_var = jnp.mean(avg * avg) - jnp.mean(avg) ** 2
+  avg_centered = avg - jnp.mean(avg)
+  avg_var = jnp.mean(avg_centered * avg_centered)
 
-  if method == 'loop':
-    _var = bst.transform.for_loop(_f_signal, jnp.moveaxis(potentials, 0, 1))
-  elif method == 'vmap':
-    _var = vmap(_f_signal, in_axes=1)(potentials)
-  else:
+  if method not in ('loop', 'vmap'):
     raise ValueError(f'Do not support {method}. We only support "loop" or "vmap".')
-  
-  var_mean = jnp.mean(_var)
+
+  centered = potentials - jnp.mean(potentials, axis=0, keepdims=True)
+  var_per_neuron = jnp.mean(centered * centered, axis=0)
+  var_mean = jnp.mean(var_per_neuron)
   r = jnp.where(var_mean == 0., 1., avg_var / var_mean)
   return r
 
@@ -215,9 +270,23 @@ def matrix_correlation(x, y):
   if y.ndim != 2:
     raise ValueError(f'Only support 2d array, but we got a array '
                      f'with the shape of {y.shape}')
-  x = x[jnp.triu_indices_from(x, k=1)]
-  y = y[jnp.triu_indices_from(y, k=1)]
-  cc = jnp.corrcoef(x, y)[0, 1]
+  if x.shape != y.shape:
+    raise ValueError(f'The two matrices should have the same shape, but we got '
+                     f'{x.shape} and {y.shape}')
+  # Pearson correlation as a masked reduction over the upper triangle: no
+  # gathered copies and no 2x2 ``corrcoef`` matrix. The sums are centered
+  # to keep float32 precision when the correlation is close to zero.
+  num_row, num_col = x.shape
+  n = sum(max(num_col - i - 1, 0) for i in range(num_row))
+  mask = jnp.triu(jnp.ones(x.shape, dtype=bool), k=1)
+  x = jnp.where(mask, x, 0.)
+  y = jnp.where(mask, y, 0.)
+  x = jnp.where(mask, x - jnp.sum(x) / n, 0.)
+  y = jnp.where(mask, y - jnp.sum(y) / n, 0.)
+  sxx = jnp.sum(x * x)
+  syy = jnp.sum(y * y)
+  sxy = jnp.sum(x * y)
+  cc = sxy / jnp.sqrt(sxx * syy)
   return cc
 
 
@@ -240,8 +309,16 @@ def functional_connectivity(activities):
   if activities.ndim != 2:
     raise ValueError('Only support 2d array with shape of "(num_time, num_sample)". '
                      f'But we got a array with the shape of {activities.shape}')
-  fc = jnp.corrcoef(activities.T)
-  return jnp.nan_to_num(fc)
+  # Flat samples have zero variance, and samples with NaN or Inf values give
+  # non-finite correlations. Both are masked out directly instead of scanning
+  # the whole matrix for NaNs, so the output stays finite.
+  flat = jnp.all(activities == activities[:1], axis=0)
+  flat = flat | ~jnp.all(jnp.isfinite(activities), axis=0)
+  centered = activities - jnp.mean(activities, axis=0)
+  std = jnp.sqrt(jnp.mean(centered * centered, axis=0))
+  z = centered / jnp.where(flat, 1., std)
+  fc = jnp.clip(jnp.matmul(z.T, z) / activities.shape[0], -1., 1.)
+  return jnp.where(flat[:, None] | flat[None, :], 0., fc)
 
 
 def functional_connectivity_dynamics(activities, window_size=30, step_size=5):
@@ -259,9 +336,41 @@ def functional_connectivity_dynamics(activities, window_size=30, step_size=5):
   Returns
   -------
   fcd_matrix: ndarray
-    FCD matrix.
+    ``num_window x num_window`` FCD matrix, where the element ``(i, j)`` is
+    the Pearson correlation between the upper triangles of the functional
+    connectivity matrices of the windows ``i`` and ``j``.
   """
-  pass
+  if activities.ndim != 2:
+    raise ValueError('Only support 2d array with shape of "(num_time, num_sample)". '
+                     f'But we got a array with the shape of {activities.shape}')
+  num_time, num_sample = activities.shape
+  if window_size < 1:
+    raise ValueError(f'"window_size" should be a positive integer, but we got {window_size}.')
+  if step_size < 1:
+    raise ValueError(f'"step_size" should be a positive integer, but we got {step_size}.')
+  if window_size > num_time:
+    raise ValueError(f'"window_size" ({window_size}) should not be larger than '
+                     f'the number of time steps ({num_time}).')
+
+  # Gather all windows and center each of them on its own mean, so that the
+  # covariances of every window come from one batched einsum without the
+  # cancellation of E[xy] - E[x]E[y]. The memory is num_window x window_size
+  # x num_sample, independent of the length of the recording.
+  starts = onp.arange(0, num_time - window_size + 1, step_size)
+  windows = activities[starts[:, None] + onp.arange(window_size)[None, :]]
+  windows = windows - jnp.mean(windows, axis=1, keepdims=True)
+  cov = jnp.einsum('wti,wtj->wij', windows, windows) / window_size
+  std = jnp.sqrt(jnp.diagonal(cov, axis1=1, axis2=2))
+  den = std[:, :, None] * std[:, None, :]
+  fc = jnp.where(den == 0., 0., cov / jnp.where(den == 0., 1., den))
+
+  # correlation between the upper triangles of all windows with one matmul
+  rows, cols = jnp.triu_indices(num_sample, k=1)
+  fc = fc[:, rows, cols]
+  fc = fc - jnp.mean(fc, axis=1, keepdims=True)
+  norm = jnp.sqrt(jnp.sum(fc * fc, axis=1))
+  fc = fc / jnp.where(norm == 0., 1., norm)[:, None]
+  return jnp.matmul(fc, fc.T)
 
 
 def weighted_correlation(x, y, w):
@@ -282,14 +391,6 @@ def weighted_correlation(x, y, w):
     Weighted correlation coefficient.
   """
 
-  def _weighted_mean(x, w):
-    """Weighted Mean"""
-    return jnp.sum(x * w) / jnp.sum(w)
-
-  def _weighted_cov(x, y, w):
-    """Weighted Covariance"""
-    return jnp.sum(w * (x - _weighted_mean(x, w)) * (y - _weighted_mean(y, w))) / jnp.sum(w)
-
   if x.ndim != 1:
     raise ValueError(f'Only support 1d array, but we got a array '
                      f'with the shape of {x.shape}')
@@ -299,4 +400,11 @@ def weighted_correlation(x, y, w):
   if w.ndim != 1:
     raise ValueError(f'Only support 1d array, but we got a array '
                      f'with the shape of {w.shape}')
-  return _weighted_cov(x, y, w) / jnp.sqrt(_weighted_cov(x, x, w) * _weighted_cov(y, y, w))
+  sw = jnp.sum(w)
+  dx = x - jnp.sum(w * x) / sw
+  dy = y - jnp.sum(w * y) / sw
+  # the normalization by sum(w) cancels in the ratio
+  cxy = jnp.sum(w * dx * dy)
+  cxx = jnp.sum(w * dx * dx)
+  cyy = jnp.sum(w * dy * dy)
+  return cxy / jnp.sqrt(cxx * cyy)
@@ -0,0 +1,52 @@
+# Copyright 2024 BDP Ecosystem Limited. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+# -*- coding: utf-8 -*-
+
+# Numba kernels of ``cross_correlation(method='numba')``. This module is only
+# imported when the method is used, since importing numba is slow.
+
+import numba
+import numpy as onp
+
+_M1 = onp.uint64(0x5555555555555555)
+_M2 = onp.uint64(0x3333333333333333)
+_M4 = onp.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = onp.uint64(0x0101010101010101)
+_S1, _S2, _S4, _S56 = onp.uint64(1), onp.uint64(2), onp.uint64(4), onp.uint64(56)
+
+
+@numba.njit(inline='always')
+def _popcount64(x):
+  # SWAR bit counting, which LLVM lowers to POPCNT when available
+  x = x - ((x >> _S1) & _M1)
+  x = (x & _M2) + ((x >> _S2) & _M2)
+  x = (x + (x >> _S4)) & _M4
+  return (x * _H01) >> _S56
+
+
+@numba.njit(parallel=True, cache=True)
+def cc_numba(packed, num_spk):
+  num_neu, num_word = packed.shape
+  res = onp.zeros(num_neu, dtype=onp.float64)
+  for i in numba.prange(num_neu):
+    for j in range(i):
+      sqrt_ij = onp.sqrt(num_spk[i] * num_spk[j])
+      if sqrt_ij > 0.:
+        num = onp.uint64(0)
+        for w in range(num_word):
+          num += _popcount64(packed[i, w] & packed[j, w])
+        res[i] += num / sqrt_ij
+  return res.sum() / (num_neu * (num_neu - 1) / 2)
@@ -16,14 +16,22 @@
 # -*- coding: utf-8 -*-
 
 
+import subprocess
+import sys
 import unittest
 from functools import partial
 import braintools as bt
+import numpy as np
 
 from jax import jit
 import jax.numpy as jnp
 import brainstate as bst
 
+try:
+  import numba
+except (ImportError, ModuleNotFoundError):
+  numba = None
+
 
 class TestCrossCorrelation(unittest.TestCase):
   def test_c(self):
@@ -70,6 +78,74 @@ class TestCrossCorrelation(unittest.TestCase):
     print(bt.metric.cross_correlation(spikes, 0.5))
     bst.util.clear_buffer_memory()
 
+  def test_cc_pairs(self):
+    spikes = bst.random.random((1001, 17)) < 0.3
+    # bins of two time steps, the last bin only contains the final step
+    padded = np.concatenate([np.asarray(spikes, dtype=float), np.zeros((1, 17))])
+    states = padded.reshape((501, 2, 17)).sum(axis=1).T > 0.
+    expected = []
+    for i in range(17):
+      for j in range(i):
+        sqrt_ij = np.sqrt(states[i].sum() * states[j].sum())
+        expected.append(0. if sqrt_ij == 0. else np.sum(states[i] * states[j]) / sqrt_ij)
+    methods = ['loop', 'vmap'] + (['numba'] if numba is not None else [])
+    for method in methods:
+      cc = bt.metric.cross_correlation(spikes, 2., dt=1., method=method)
+      self.assertTrue(np.allclose(cc, np.mean(expected), atol=1e-5))
+    bst.util.clear_buffer_memory()
+
+  def test_cc_chunk(self):
+    spikes = bst.random.random((1000, 37)) < 0.2
+    cc1 = bt.metric.cross_correlation(spikes, 0.5)
+    for chunk_size in [1, 5, 37, 100]:
+      cc2 = bt.metric.cross_correlation(spikes, 0.5, chunk_size=chunk_size)
+      self.assertTrue(jnp.allclose(cc1, cc2, atol=1e-6))
+    f_cc = jit(partial(bt.metric.cross_correlation, bin=0.5, chunk_size=8))
+    self.assertTrue(jnp.allclose(cc1, f_cc(spikes), atol=1e-6))
+    for chunk_size in [0, -1, 2.]:
+      with self.assertRaises(ValueError):
+        bt.metric.cross_correlation(spikes, 0.5, chunk_size=chunk_size)
+    bst.util.clear_buffer_memory()
+
+  def test_cc_chunk_cache(self):
+    # repeated eager calls reuse the compiled tile loop
+    from braintools.metric._correlation import _cc_tiles
+    spikes = bst.random.random((500, 23)) < 0.2
+    bt.metric.cross_correlation(spikes, 1., dt=1., chunk_size=4)
+    num_compiled = _cc_tiles._cache_size()
+    for _ in range(3):
+      bt.metric.cross_correlation(spikes, 1., dt=1., chunk_size=4)
+    self.assertEqual(_cc_tiles._cache_size(), num_compiled)
+    bst.util.clear_buffer_memory()
+
+  @unittest.skipIf(numba is None, 'numba is not installed')
+  def test_cc_numba(self):
+    spikes = jnp.ones((1000, 10))
+    self.assertTrue(np.allclose(bt.metric.cross_correlation(spikes, 1., dt=1., method='numba'), 1.))
+    spikes = jnp.zeros((1000, 10))
+    self.assertTrue(bt.metric.cross_correlation(spikes, 1., dt=1., method='numba') == 0.)
+    # 150 and 100 bins are not multiples of 64, so the last uint64 word is padded
+    spikes = bst.random.random((300, 13)) < 0.3
+    for bin_size in [2., 3.]:
+      cc1 = bt.metric.cross_correlation(spikes, bin_size, dt=1.)
+      cc2 = bt.metric.cross_correlation(spikes, bin_size, dt=1., method='numba')
+      self.assertTrue(np.allclose(cc1, cc2, atol=1e-6))
+    bst.util.clear_buffer_memory()
+
+  def test_numba_lazy_import(self):
+    # importing braintools does not import numba
+    code = 'import sys, braintools; print("numba" in sys.modules)'
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    self.assertEqual(out.stdout.strip(), 'False')
+
+  def test_cc_single_neuron(self):
+    spikes = bst.random.random((100, 1)) < 0.5
+    methods = ['loop', 'vmap'] + (['numba'] if numba is not None else [])
+    for method in methods:
+      self.assertTrue(jnp.isnan(bt.metric.cross_correlation(spikes, 1., dt=1., method=method)))
+    with self.assertRaises(ValueError):
+      bt.metric.cross_correlation(spikes, 1., dt=1., method='unknown')
+
 
 class TestVoltageFluctuation(unittest.TestCase):
   def test_vf1(self):
@@ -88,6 +164,16 @@ class TestVoltageFluctuation(unittest.TestCase):
 
     bst.util.clear_buffer_memory()
 
+  def test_vf_offset(self):
+    # resting potentials with a large offset should not lose precision in float32
+    voltages = np.random.RandomState(0).normal(0., 0.01, size=(1000, 10))
+    voltages[:, :5] += np.sin(np.linspace(0., 20., 1000))[:, None] * 0.01
+    avg = voltages.mean(axis=1)
+    expected = avg.var() / voltages.var(axis=0).mean()
+    r = bt.metric.voltage_fluctuation(jnp.asarray(voltages - 65., dtype=jnp.float32))
+    self.assertTrue(np.allclose(r, expected, rtol=1e-3))
+    bst.util.clear_buffer_memory()
+
 
 class TestFunctionalConnectivity(unittest.TestCase):
   def test_cf1(self):
@@ -100,6 +186,68 @@ class TestFunctionalConnectivity(unittest.TestCase):
     self.assertTrue(jnp.allclose(r1, r2))
     bst.util.clear_buffer_memory()
 
+  def test_cf_flat(self):
+    act = np.random.RandomState(0).random((1000, 4))
+    act[:, 1] = 3.
+    act[:, 3] += act[:, 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      expected = np.nan_to_num(np.corrcoef(act.T))
+    r = bt.metric.functional_connectivity(jnp.asarray(act))
+    self.assertTrue(np.allclose(r, expected, atol=1e-5))
+    self.assertTrue(np.all(r[1] == 0.) and np.all(r[:, 1] == 0.))
+    bst.util.clear_buffer_memory()
+
+  def test_cf_nonfinite(self):
+    act = np.random.RandomState(0).random((1000, 4))
+    act[10, 1] = np.nan
+    act[20, 2] = np.inf
+    with np.errstate(invalid='ignore', divide='ignore'):
+      expected = np.nan_to_num(np.corrcoef(act.T))
+    r = bt.metric.functional_connectivity(jnp.asarray(act))
+    self.assertTrue(np.all(np.isfinite(r)))
+    self.assertTrue(np.all(r[1:3] == 0.) and np.all(r[:, 1:3] == 0.))
+    self.assertTrue(np.allclose(r, expected, atol=1e-5))
+    bst.util.clear_buffer_memory()
+
+
+class TestFunctionalConnectivityDynamics(unittest.TestCase):
+  def test_fcd(self):
+    act = np.random.RandomState(0).normal(size=(200, 6))
+    act[:, 1] += act[:, 0]
+    indices = np.triu_indices(6, k=1)
+    fcs = [np.corrcoef(act[i: i + 30].T)[indices] for i in range(0, 171, 5)]
+    expected = np.corrcoef(np.asarray(fcs))
+
+    r1 = bt.metric.functional_connectivity_dynamics(jnp.asarray(act), window_size=30, step_size=5)
+    jit_f = jit(partial(bt.metric.functional_connectivity_dynamics, window_size=30, step_size=5))
+    r2 = jit_f(jnp.asarray(act))
+    self.assertEqual(r1.shape, (35, 35))
+    self.assertTrue(np.allclose(r1, expected, atol=1e-5))
+    self.assertTrue(np.allclose(r2, expected, atol=1e-5))
+    bst.util.clear_buffer_memory()
+
+  def test_fcd_drift(self):
+    # a long recording with a slowly drifting mean
+    num_time = 100000
+    act = np.random.RandomState(0).normal(size=(num_time, 6))
+    act += np.linspace(0., 50., num_time)[:, None]
+    indices = np.triu_indices(6, k=1)
+    starts = range(0, num_time - 30 + 1, 2000)
+    fcs = [np.corrcoef(act[i: i + 30].T)[indices] for i in starts]
+    expected = np.corrcoef(np.asarray(fcs))
+
+    r = bt.metric.functional_connectivity_dynamics(jnp.asarray(act, dtype=jnp.float32),
+                                                   window_size=30, step_size=2000)
+    self.assertEqual(r.shape, expected.shape)
+    self.assertTrue(np.allclose(r, expected, atol=1e-5))
+    bst.util.clear_buffer_memory()
+
+  def test_fcd_args(self):
+    act = jnp.ones((100, 3))
+    for window_size, step_size in [(0, 5), (-1, 5), (30, 0), (30, -1), (101, 5)]:
+      with self.assertRaises(ValueError):
+        bt.metric.functional_connectivity_dynamics(act, window_size=window_size, step_size=step_size)
+
 
 class TestMatrixCorrelation(unittest.TestCase):
   def test_mc(self):
@@ -113,4 +261,24 @@ class TestMatrixCorrelation(unittest.TestCase):
     self.assertTrue(jnp.allclose(r1, r2))
     bst.util.clear_buffer_memory()
 
+  def test_mc2(self):
+    A = np.random.RandomState(0).random((50, 50))
+    B = np.random.RandomState(1).random((50, 50)) + 0.5 * A
+    indices = np.triu_indices(50, k=1)
+    expected = np.corrcoef(A[indices], B[indices])[0, 1]
+    r = bt.metric.matrix_correlation(jnp.asarray(A), jnp.asarray(B))
+    self.assertTrue(np.allclose(r, expected, atol=1e-5))
+    bst.util.clear_buffer_memory()
+
 
+class TestWeightedCorrelation(unittest.TestCase):
+  def test_wc(self):
+    rng = np.random.RandomState(0)
+    x = rng.normal(size=500)
+    y = x + rng.normal(size=500)
+    w = rng.random(500)
+    cov = np.cov(np.stack([x, y]), aweights=w)
+    expected = cov[0, 1] / np.sqrt(cov[0, 0] * cov[1, 1])
+    r = bt.metric.weighted_correlation(jnp.asarray(x), jnp.asarray(y), jnp.asarray(w))
+    self.assertTrue(np.allclose(r, expected, atol=1e-5))
+    bst.util.clear_buffer_memory()